@@ -6,6 +6,17 @@ import zipfile
 import json
 from typing import Dict, List
 import transformers
+try:
+    import orjson
+    json_loads = orjson.loads
+
+    def json_dumps(obj):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+except ImportError:
+    json_loads = json.loads
+
+    def json_dumps(obj):
+        return json.dumps(obj).encode('utf-8')
 __all__ = ('get_analogy_data', 'get_lama_data')
 relations_google = [
     {
@@ -46,6 +57,48 @@ def wget(url, cache_dir):
     os.remove('{}/{}'.format(cache_dir, filename))
 
 
+def load_json(path):
+    """ Load json file (with orjson if available). """
+    with open(path, 'rb') as f:
+        return json_loads(f.read())
+
+
+def dump_json(obj, path):
+    """ Export object as json file (with orjson if available). """
+    with open(path, 'wb') as f:
+        f.write(json_dumps(obj))
+
+
+def dump_json_stream(dicts, path):
+    """ Export the union of an iterable of dictionaries as a single json object, writing one entry at a time so that
+    the merged dictionary is never built in memory. A key found in more than one dictionary keeps its first value. """
+    written = set()
+    with open(path, 'wb') as f:
+        f.write(b'{')
+        separator = b''
+        for d in dicts:
+            for k, v in d.items():
+                k = str(k)
+                if k in written:
+                    continue
+                written.add(k)
+                f.write(separator + json_dumps(k) + b':' + json_dumps(v))
+                separator = b','
+        f.write(b'}')
+
+
+def iter_jsonl(path):
+    """ Iterate over parsed lines of a jsonl file without reading the whole file at once. """
+    with open(path, 'r', buffering=1 << 20) as f:
+        for line in f:
+            if line.strip():
+                yield json_loads(line)
+
+
+def load_jsonl(path):
+    return list(iter_jsonl(path))
+
+
 def get_analogy_data(data_name: str, cache_dir: str = default_cache_dir_analogy):
     """ Get SAT-type dataset: a list of (answer: int, prompts: list, stem: list, choice: list)"""
     assert data_name in ['sat', 'u2', 'u4', 'google', 'bats'], 'unknown data: {}'.format(data_name)
@@ -53,10 +106,8 @@ def get_analogy_data(data_name: str, cache_dir: str = default_cache_dir_analogy)
         url = '{}/{}.zip'.format(root_url_analogy, data_name)
         wget(url, cache_dir)
 
-    with open('{}/{}/test.jsonl'.format(cache_dir, data_name), 'r') as f:
-        test = list(filter(None, map(lambda x: json.loads(x) if len(x) > 0 else None, f.read().split('\n'))))
-    with open('{}/{}/valid.jsonl'.format(cache_dir, data_name), 'r') as f:
-        val = list(filter(None, map(lambda x: json.loads(x) if len(x) > 0 else None, f.read().split('\n'))))
+    test = load_jsonl('{}/{}/test.jsonl'.format(cache_dir, data_name))
+    val = load_jsonl('{}/{}/valid.jsonl'.format(cache_dir, data_name))
     return val, test
 
 
@@ -102,30 +153,30 @@ def get_lama_data(cache_dir: str = None,
 
     full_set = {}
 
-    def load_jsonl(__file):
-        with open(__file, 'r') as _f:
-            return list(filter(None, map(lambda x: json.loads(x) if len(x) else None, _f.read().split('\n'))))
+    # keys shared by all the vocabularies to check obj_label in one lookup
+    shared_vocab = frozenset.intersection(*[frozenset(v.keys()) for v in vocab_list]) if vocab_list else None
 
     def get_value(_dict, template: str = None, is_squad=False):
-        try:
-            # Squad does not have subject label
-            if is_squad:
-                _dict['sub_label'] = ''
-            # single character object could be a broken entry
-            if len(_dict['obj_label']) == 1:
-                return None
-            if vocab_list:  # make sure obj_label is in vocabulary
-                assert vocab_list[0][_dict['obj_label']]
-                assert all(v[_dict['obj_label']] for v in vocab_list)
-            if template:
-                _dict['prompt'] = parse_template(template, _dict['sub_label'])
-            else:
-                assert len(_dict['masked_sentences']) == 1 and type(_dict['masked_sentences']) is list
-                # _dict['prompt'] = _dict['masked_sentences'][0].replace('[MASK]', _dict['obj_label'])
-                _dict['prompt'] = _dict['masked_sentences'][0]
-            return {k: _dict[k] for k in ['obj_label', 'sub_label', 'prompt']}
-        except KeyError:
+        # Squad does not have subject label
+        if is_squad:
+            _dict['sub_label'] = ''
+        if 'obj_label' not in _dict or 'sub_label' not in _dict:
             return None
+        # single character object could be a broken entry
+        if len(_dict['obj_label']) == 1:
+            return None
+        # make sure obj_label is in vocabulary
+        if shared_vocab is not None and _dict['obj_label'] not in shared_vocab:
+            return None
+        if template:
+            _dict['prompt'] = parse_template(template, _dict['sub_label'])
+        else:
+            if 'masked_sentences' not in _dict:
+                return None
+            assert len(_dict['masked_sentences']) == 1 and type(_dict['masked_sentences']) is list
+            # _dict['prompt'] = _dict['masked_sentences'][0].replace('[MASK]', _dict['obj_label'])
+            _dict['prompt'] = _dict['masked_sentences'][0]
+        return {k: _dict[k] for k in ['obj_label', 'sub_label', 'prompt']}
 
     logging.debug('processing data')
 
@@ -147,8 +198,9 @@ def get_lama_data(cache_dir: str = None,
             if not os.path.exists(_file):
                 logging.debug('\t FILE SKIPPED: file not found {}'.format(_file))
             else:
+                # filter entries while streaming the file
                 data = list(filter(None, map(
-                    lambda x: get_value(x, template=r['template'], is_squad=i == 'Squad'), load_jsonl(_file))))
+                    lambda x: get_value(x, template=r['template'], is_squad=i == 'Squad'), iter_jsonl(_file))))
                 if drop_duplicated_prompt:
                     # pick one entry from what share same prompt i.e. same template and subject
                     unique_prompt = list(set([d['prompt'] for d in data]))
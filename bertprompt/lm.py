@@ -2,54 +2,61 @@
 import re
 import os
 import logging
-import math
+import hashlib
+import heapq
+import shelve
 from itertools import chain
-from typing import List
+from typing import List, Dict
 from tqdm import tqdm
-from copy import deepcopy
-from multiprocessing import Pool
 
+import numpy as np
 import transformers
 import torch
 from torch import nn
 
 os.environ["TOKENIZERS_PARALLELISM"] = "false"  # to turn off warning message
 PAD_TOKEN_LABEL_ID = nn.CrossEntropyLoss().ignore_index
+AUTOCAST_DTYPE = {'fp16': torch.float16, 'bf16': torch.bfloat16, 'fp32': None}
+ENCODE_VERSION = 2  # bump when the output of `EncodePlus` changes, so that cached encodes are not reused
 __all__ = ('get_partition', 'Prompter')
 
 
-def pool_map(f, arg):
-    """ Multiprocessing map function. """
-    _pool = Pool()
-    out = _pool.map(f, arg)
-    _pool.close()
-    return out
-
-
 def get_partition(_list):
-    """ Get partition in multiprocess. """
-    p = Partition(_list)
-    return pool_map(p, range(len(_list)))
+    """ Get the partition information of a nested list for restoring the original structure. """
+    ends = np.cumsum(np.fromiter((len(i) for i in _list), dtype=np.int64, count=len(_list)))
+    starts = np.concatenate(([0], ends[:-1]))
+    return list(zip(starts.tolist(), ends.tolist()))
 
 
-def get_encoding(sentences, tokenizer, max_length, token_wise_mask: bool = None):
-    """ Get encode_plus in multiprocess. """
-    p = EncodePlus(tokenizer, max_length, token_wise_mask=token_wise_mask)
-    return pool_map(p, sentences)
+def get_length_order(data: List):
+    """ Get the index order that sorts encodes by their length. """
+    return sorted(range(len(data)), key=lambda x: len(data[x]['input_ids']))
 
 
-class Partition:
-    """ Get the partition information of a nested list for restoring the original structure. """
+def restore_order(_list: List, order: List):
+    """ Restore the original order of a list sorted by `order`. """
+    restored = [None] * len(_list)
+    for n, i in enumerate(order):
+        restored[i] = _list[n]
+    return restored
 
-    def __init__(self, _list):
-        self.length = pool_map(len, _list)
 
-    def __call__(self, x):
-        return [sum(self.length[:x]), sum(self.length[:x + 1])]
+def get_encoding(sentences, tokenizer, max_length, token_wise_mask: bool = None, cache: Dict = None):
+    """ Get encode_plus in a single batch call of the fast tokenizer, reusing encodes stored in `cache` if given. """
+    p = EncodePlus(tokenizer, max_length, token_wise_mask=token_wise_mask)
+    if cache is None:
+        return p(sentences)
+    keys = [hashlib.blake2b('{}\t{}\t{}\t{}\t{}'.format(
+        ENCODE_VERSION, tokenizer.name_or_path, p.max_length, token_wise_mask, s).encode('utf-8')).hexdigest()
+        for s in sentences]
+    new_keys = {k: s for k, s in zip(keys, sentences) if k not in cache}
+    if len(new_keys):
+        cache.update(zip(new_keys.keys(), p(list(new_keys.values()))))
+    return [cache[k] for k in keys]
 
 
 class EncodePlus:
-    """ Get encode_plus output in parallel. """
+    """ Get encode_plus output in batch with the fast tokenizer. """
 
     def __init__(self, tokenizer, max_length, token_wise_mask: bool = None):
         self.tokenizer = tokenizer
@@ -93,58 +100,78 @@ class EncodePlus:
                 label[p] = i
         return label
 
-    def __call__(self, sentence):
-        """ Encoding sentence with label that is
+    def __call__(self, sentences):
+        """ Encoding sentences with label that is
         - masked token if `token_wise_mask` is False (mainly for token prediction)
         - otherwise every token that is not mask token (mainly for perplexity computation)
 
         Parameters
         ----------
-        sentence : str
-            A string sentence.
+        sentences : list
+            A list of string sentences.
 
         Returns
         -------
-        A list of the output from tokenizer.encode_plus .
+        A list (one for each sentence) of lists of the encode_plus style output.
         """
+        mask = self.tokenizer.mask_token
         if self.token_wise_mask is not None:
-            token_wise_mask = self.token_wise_mask
-        else:
-            token_wise_mask = self.tokenizer.mask_token not in sentence
-        param = {'max_length': self.max_length, 'truncation': True, 'padding': 'max_length'}
-        if not token_wise_mask:
-            assert self.tokenizer.mask_token in sentence, 'sentence has no masks: {}'.format(sentence)
-            encode = self.tokenizer.encode_plus(sentence, **param)
-            assert encode['input_ids'][-1] == self.tokenizer.pad_token_id, 'exceeded max_length'
-            return [encode]
+            token_wise_mask = [self.token_wise_mask] * len(sentences)
         else:
-            token_list = self.tokenizer.tokenize(sentence)
-
-            def encode_with_single_mask_id(mask_position: int):
-                _token_list = token_list.copy()  # can not be encode outputs because of prefix
-                masked_token_id = self.tokenizer.convert_tokens_to_ids(_token_list[mask_position])
+            token_wise_mask = [mask not in s for s in sentences]
+        # no padding here, each batch is padded to its longest sequence by `Dataset.collate_fn`
+        param = {'max_length': self.max_length, 'truncation': True, 'padding': False}
+
+        # tokenize sentences that need token-wise masking in one batch
+        index_token_wise = [n for n, t in enumerate(token_wise_mask) if t]
+        token_lists = {}
+        if len(index_token_wise):
+            tokenized = self.tokenizer([sentences[n] for n in index_token_wise], add_special_tokens=False)
+            token_lists = {n: tokenized.tokens(i) for i, n in enumerate(index_token_wise)}
+
+        # collect every string to encode with the index of its sentence and its label (position, id)
+        batch_string, batch_index, batch_label = [], [], []
+        for n, sentence in enumerate(sentences):
+            if not token_wise_mask[n]:
+                assert mask in sentence, 'sentence has no masks: {}'.format(sentence)
+                batch_string.append(sentence)
+                batch_index.append(n)
+                batch_label.append(None)
+                continue
+            token_list = token_lists[n]
+            length = min(self.max_length - len(self.sp_token_prefix), len(token_list))
+            for mask_position in range(length):
+                masked_token_id = self.tokenizer.convert_tokens_to_ids(token_list[mask_position])
                 if masked_token_id == self.tokenizer.mask_token_id:
-                    return None
-                _token_list[mask_position] = self.tokenizer.mask_token
-                tmp_string = self.tokenizer.convert_tokens_to_string(_token_list)
-                _encode = self.tokenizer.encode_plus(tmp_string, **param)
-                assert _encode['input_ids'][-1] == self.tokenizer.pad_token_id, 'exceeded max_length'
+                    continue
+                _token_list = token_list.copy()  # can not be encode outputs because of prefix
+                _token_list[mask_position] = mask
+                batch_string.append(self.tokenizer.convert_tokens_to_string(_token_list))
+                batch_index.append(n)
+                batch_label.append((mask_position + len(self.sp_token_prefix), masked_token_id))
+
+        encodes = [[] for _ in sentences]
+        if len(batch_string) == 0:
+            return encodes
+        batch_encode = self.tokenizer(batch_string, **param)
+        for i, (n, label) in enumerate(zip(batch_index, batch_label)):
+            _encode = {k: v[i] for k, v in batch_encode.items()}
+            assert len(_encode['input_ids']) < self.max_length, 'exceeded max_length'
+            if label is not None:
                 _encode['labels'] = self.input_ids_to_labels(
-                    _encode['input_ids'],
-                    label_position=[mask_position + len(self.sp_token_prefix)],
-                    label_id=[masked_token_id])
-                return _encode
-
-            length = min(self.max_length - len(self.sp_token_prefix), len(token_list))
-            return list(filter(None, map(encode_with_single_mask_id, range(length))))
+                    _encode['input_ids'], label_position=[label[0]], label_id=[label[1]])
+            encodes[n].append(_encode)
+        return encodes
 
 
 class Dataset(torch.utils.data.Dataset):
     """ `torch.utils.data.Dataset` """
     float_tensors = ['attention_mask']
 
-    def __init__(self, data: List):
+    def __init__(self, data: List, pad_token_id: int = 0, pad_to_multiple_of: int = None):
         self.data = data  # a list of dictionaries
+        self.pad_value = {'input_ids': pad_token_id, 'labels': PAD_TOKEN_LABEL_ID}
+        self.pad_to_multiple_of = pad_to_multiple_of
 
     def __len__(self):
         return len(self.data)
@@ -157,6 +184,18 @@ class Dataset(torch.utils.data.Dataset):
     def __getitem__(self, idx):
         return {k: self.to_tensor(k, v) for k, v in self.data[idx].items()}
 
+    def collate_fn(self, batch: List):
+        """ Pad each batch to the length of its longest sequence (rounded up to `pad_to_multiple_of` if given) """
+        length = max(len(b['input_ids']) for b in batch)
+        if self.pad_to_multiple_of:
+            length = -(-length // self.pad_to_multiple_of) * self.pad_to_multiple_of
+        output = {}
+        for k in batch[0].keys():
+            padded = nn.utils.rnn.pad_sequence(
+                [b[k] for b in batch], batch_first=True, padding_value=self.pad_value.get(k, 0))
+            output[k] = nn.functional.pad(padded, (0, length - padded.shape[1]), value=self.pad_value.get(k, 0))
+        return output
+
 
 class Prompter:
     """ Prompt generator based on pretrained language models """
@@ -165,7 +204,10 @@ class Prompter:
                  model: str,
                  max_length: int = 32,
                  cache_dir: str = None,
-                 num_worker: int = 0):
+                 num_worker: int = 0,
+                 encode_cache_dir: str = None,
+                 compile_model: bool = False,
+                 dtype: str = 'fp16'):
         """ Prompt generator based on pretrained language models
 
         Parameters
@@ -176,29 +218,53 @@ class Prompter:
             A model max length if specified, else use model_max_length.
         cache_dir : str
         num_worker : int
+        encode_cache_dir : str
+            (optional) Directory to persist tokenizer encodes across runs.
+        compile_model : bool
+            Compile the model with `torch.compile` (PyTorch 2.x), after converting it with BetterTransformer if
+            `optimum` is available.
+        dtype : str
+            Autocast precision of the forward pass on GPU (fp16/bf16/fp32), parameters are kept in fp32.
         """
         logging.debug('Initialize `Prompter`')
         assert 'bert' in model, '{} is not BERT'.format(model)
         self.num_worker = num_worker
+        assert dtype in AUTOCAST_DTYPE, 'unknown dtype: {}'.format(dtype)
+        self.dtype = dtype
         self.model_name = model
         self.cache_dir = cache_dir
         self.device = None
         self.model = None
         self.max_length = max_length
+        # a compiled model is specialized on input shapes, so round padded lengths up to a few buckets
+        self.pad_to_multiple_of = 8 if compile_model else None
+        self.ppl_cache = {}  # sentence -> perplexity, cleared at every `generate` call
+        self.encode_cache = None
+        if encode_cache_dir:
+            os.makedirs(encode_cache_dir, exist_ok=True)
+            self.encode_cache = shelve.open('{}/encode'.format(encode_cache_dir))
         try:
-            self.tokenizer = transformers.AutoTokenizer.from_pretrained(model, cache_dir=cache_dir)
+            self.tokenizer = transformers.AutoTokenizer.from_pretrained(model, cache_dir=cache_dir, use_fast=True)
         except ValueError:
-            self.tokenizer = transformers.AutoTokenizer.from_pretrained(model, cache_dir=cache_dir, local_files_only=True)
+            self.tokenizer = transformers.AutoTokenizer.from_pretrained(
+                model, cache_dir=cache_dir, use_fast=True, local_files_only=True)
+        assert self.tokenizer.is_fast, '{} has no fast tokenizer'.format(model)
+        # compiled regex for `cleanup_decode`
+        mask = self.tokenizer.mask_token
+        specials = sorted([t for t in self.tokenizer.all_special_tokens if t != mask], key=len, reverse=True)
+        self._clean_re = re.compile(r'|'.join(['({})'.format(re.escape(mask))] + [re.escape(t) for t in specials]))
+        self._space_re = re.compile(r'\s+')
+        # let the rust tokenizer run in parallel unless DataLoader forks worker processes
+        os.environ["TOKENIZERS_PARALLELISM"] = "true" if self.num_worker == 0 else "false"
         try:
             self.config = transformers.AutoConfig.from_pretrained(model, cache_dir=cache_dir, output_hidden_states=True)
         except ValueError:
             self.config = transformers.AutoConfig.from_pretrained(
                 model, cache_dir=cache_dir, output_hidden_states=True, local_files_only=True)
+        self.__load_model(compile_model)
 
-    def __load_model(self):
+    def __load_model(self, compile_model: bool = False):
         """ Load pretrained language model """
-        if self.model:
-            return
         logging.debug('loading language model')
         try:
             self.model = transformers.AutoModelForMaskedLM.from_pretrained(
@@ -211,19 +277,53 @@ class Prompter:
         self.device = 'cuda' if torch.cuda.device_count() > 0 else 'cpu'
         self.model.to(self.device)
         logging.debug('running on {} GPU'.format(torch.cuda.device_count()))
+        if compile_model:
+            assert hasattr(torch, 'compile'), 'torch.compile requires PyTorch 2.x'
+            try:
+                # fused attention kernels if `optimum` is installed
+                from optimum.bettertransformer import BetterTransformer
+                self.model = BetterTransformer.transform(self.model)
+            except ImportError:
+                logging.debug('optimum is not installed, skip BetterTransformer')
+            except (NotImplementedError, ValueError) as e:
+                logging.info('BetterTransformer does not support {}, skip it: {}'.format(self.model_name, e))
+            # batch size and (bucketed) length vary across batches, so compile with dynamic shapes rather than
+            # capturing a CUDA graph for every shape
+            self.model = torch.compile(self.model, dynamic=True)
+
+    def __get_encoding(self, sentences: List, token_wise_mask: bool = None, encode_cache: Dict = None):
+        """ Get encodes through `encode_cache` (sentence to encodes for the given `token_wise_mask`) and the on-disk
+        cache if `encode_cache_dir` is given """
+        if encode_cache is not None:
+            new_sentences = list(dict.fromkeys(s for s in sentences if s not in encode_cache))
+            if len(new_sentences):
+                encode_cache.update(zip(new_sentences, self.__get_encoding(new_sentences, token_wise_mask)))
+            return [encode_cache[s] for s in sentences]
+        data = get_encoding(sentences, self.tokenizer, self.max_length, token_wise_mask=token_wise_mask,
+                            cache=self.encode_cache)
+        if self.encode_cache is not None:
+            self.encode_cache.sync()
+        return data
+
+    def __get_data_loader(self, data: List, batch_size: int):
+        """ DataLoader with pinned memory so that host to device copy can overlap with the forward pass """
+        dataset = Dataset(data, pad_token_id=self.tokenizer.pad_token_id, pad_to_multiple_of=self.pad_to_multiple_of)
+        return torch.utils.data.DataLoader(
+            dataset, num_workers=self.num_worker, batch_size=batch_size, shuffle=False, drop_last=False,
+            collate_fn=dataset.collate_fn, pin_memory=self.device == 'cuda')
+
+    def __autocast(self):
+        """ Mixed precision context for the forward pass, which is disabled on CPU or with fp32 """
+        if self.device == 'cuda' and AUTOCAST_DTYPE[self.dtype] is not None:
+            return torch.autocast(device_type='cuda', dtype=AUTOCAST_DTYPE[self.dtype])
+        return torch.autocast(device_type='cpu', enabled=False)
 
     def cleanup_decode(self, sentence):
         """ Clean up sentence with toknizers special tokens """
-        mask = self.tokenizer.mask_token
-        # give a space around mask token
-        cleaned_sent = re.sub(r'({})'.format(mask).replace('[', '\[').replace(']', '\]'), r' \1 ', sentence)
-        # reduce more than two spaces to one
-        cleaned_sent = re.sub(r'\s+', ' ', cleaned_sent)
-        # remove special tokens but keep mask
-        to_remove = list(filter(lambda x: x != mask, self.tokenizer.all_special_tokens))
-        cleaned_sent = re.sub(r'|'.join(list(map(re.escape, to_remove))), '', cleaned_sent)
-        # remove redundant spaces on the beginning of the sentence
-        return re.sub(r'\A\s*', '', cleaned_sent)
+        # give a space around mask token and remove other special tokens in one pass
+        cleaned_sent = self._clean_re.sub(lambda m: ' {} '.format(m.group(1)) if m.group(1) else '', sentence)
+        # reduce more than two spaces to one and remove redundant spaces on the beginning of the sentence
+        return self._space_re.sub(' ', cleaned_sent).lstrip()
 
     def pair_to_seed(self,
                      word_pair: List,
@@ -279,12 +379,16 @@ class Prompter:
         n_blank_e : see Prompter.pair_to_seed
         """
         tol = 0.05
+        # token-wise masked encodes of current seed sentences, reused across steps
+        encode_cache = {}
+        # perplexity is reused across the revision steps of a call, so do not let it grow over calls
+        self.ppl_cache = {}
         if seed_sentences:
             assert not word_pairs, 'both of `seed_sentences` and `word_pairs` are given'
             if type(seed_sentences) is str:
                 seed_sentences = [seed_sentences]
             assert all(map(len, seed_sentences)), 'empty string found in {}'.format(seed_sentences)
-            ppl = self.get_perplexity(seed_sentences, batch_size=batch_size)
+            ppl = self.get_perplexity(seed_sentences, batch_size=batch_size, encode_cache=encode_cache)
             edit = [[s] for s in seed_sentences]
             edit_ppl = [[s] for s in ppl]
             data_key = {k: v for k, v in enumerate(seed_sentences)}
@@ -292,14 +396,14 @@ class Prompter:
             assert word_pairs, 'either of `seed_sentences` or `word_pairs` is required'
             if type(word_pairs[0]) is not list:
                 word_pairs = [word_pairs]
-            seed_sentences = list(map(lambda x: self.pair_to_seed(
-                x, n_blank=n_blank, n_blank_b=n_blank_b, n_blank_e=n_blank_e), word_pairs))
+            seed_sentences = [self.pair_to_seed(x, n_blank=n_blank, n_blank_b=n_blank_b, n_blank_e=n_blank_e)
+                              for x in word_pairs]
             data_key = {k: '||'.join(v) for k, v in enumerate(word_pairs)}
             logging.info('### REPLACE MASK ###')
             edit = [seed_sentences]
             edit_ppl = [self.get_perplexity(seed_sentences, batch_size=batch_size)]
             while True:
-                if any(map(lambda x: self.tokenizer.mask_token not in x, seed_sentences)):
+                if any(self.tokenizer.mask_token not in x for x in seed_sentences):
                     # mask should be removed one by one, but some has skipped if this raises error
                     assert all(self.tokenizer.mask_token not in i for i in seed_sentences), 'some masks got lost'
                     break
@@ -309,8 +413,10 @@ class Prompter:
                     vocab_to_keep=word_pairs,
                     vocab_to_keep_unique=vocab_to_keep_unique,
                     topk=topk,
-                    batch_size=batch_size
+                    batch_size=batch_size,
+                    encode_cache=encode_cache
                 )
+                encode_cache = {s: encode_cache[s] for s in seed_sentences if s in encode_cache}
                 edit.append(seed_sentences)
                 edit_ppl.append(ppl)
 
@@ -333,24 +439,28 @@ class Prompter:
                 vocab_to_keep_unique=vocab_to_keep_unique,
                 topk=topk,
                 batch_size=batch_size,
-                token_wise_mask=True
+                token_wise_mask=True,
+                encode_cache=encode_cache
             )
 
             # sentence keep improving
-            index_unfixed = list(filter(lambda x: (edit_ppl[x][-1] - ppl[x]) > tol, range(len(seed_sentences))))
+            index_unfixed = [x for x in range(len(seed_sentences)) if (edit_ppl[x][-1] - ppl[x]) > tol]
 
             # extract stable sentence
-            index_fixed = list(filter(lambda x: x not in index_unfixed, range(len(seed_sentences))))
+            index_unfixed_set = set(index_unfixed)
+            index_fixed = [x for x in range(len(seed_sentences)) if x not in index_unfixed_set]
             for n in index_fixed:
                 output_list[data_index[n]] = [edit[n], edit_ppl[n]]
 
-            edit = list(map(lambda x: tuple(list(edit[x]) + [seed_sentences[x]]), index_unfixed))
-            edit_ppl = list(map(lambda x: tuple(list(edit_ppl[x]) + [ppl[x]]), index_unfixed))
-            seed_sentences = list(map(lambda x: seed_sentences[x], index_unfixed))
-            ppl = list(map(lambda x: ppl[x], index_unfixed))
-            data_index = list(map(lambda x: data_index[x], index_unfixed))
+            edit = [tuple(edit[x]) + (seed_sentences[x],) for x in index_unfixed]
+            edit_ppl = [tuple(edit_ppl[x]) + (ppl[x],) for x in index_unfixed]
+            seed_sentences = [seed_sentences[x] for x in index_unfixed]
+            ppl = [ppl[x] for x in index_unfixed]
+            data_index = [data_index[x] for x in index_unfixed]
+            # drop encodes of the sentences that are not revised anymore
+            encode_cache = {s: encode_cache[s] for s in seed_sentences if s in encode_cache}
             if vocab_to_keep:
-                vocab_to_keep = list(map(lambda x: vocab_to_keep[x], index_unfixed))
+                vocab_to_keep = [vocab_to_keep[x] for x in index_unfixed]
 
             if len(seed_sentences) == 0:
                 logging.info('ITERATIVE REVISION: all sentences reached the best perplexity')
@@ -367,7 +477,8 @@ class Prompter:
                              vocab_to_keep_unique: bool = False,
                              batch_size: int = 4,
                              topk: int = 5,
-                             token_wise_mask: bool = None):
+                             token_wise_mask: bool = None,
+                             encode_cache: Dict = None):
         """ Replace single token (run parallel over given lists)
         - (i) Greedy token prediction: predict token by masking each token or masked token if sentence consists of mask
         - (ii) Perplexity re-ranking: choose the best replaced sentence that achieves the best perplexity
@@ -379,53 +490,78 @@ class Prompter:
         vocab_to_keep_unique : (optional) only to include unique word from vocab_to_keep
         batch_size : batch size
         topk : keep topk prediction on masked token for perplexity filtering
+        encode_cache : (optional) a dictionary of sentence to token-wise masked encodes to reuse and update
         """
 
-        def check_vocab(sentence, vocab):
+        def check_vocab(sentence, vocab, vocab_pattern):
+            """ `vocab_pattern` is the compiled alternation of unique vocab (see `get_vocab_pattern`) """
             if not vocab_to_keep_unique:
                 return True
-            vocab_unique = list(set(vocab))
-            vocab_unique = sorted(vocab_unique, reverse=True)
-            vocab_in = re.findall(r'|'.join(vocab_unique).lower(), sentence.lower())
-            vocab_in_unique = list(set(vocab_in))
+            vocab_in = vocab_pattern.findall(sentence.lower())
+            vocab_in_unique = set(vocab_in)
             if len(vocab_in_unique) == len(vocab_in) == len(vocab):
                 return True
-            elif len(vocab_unique) != len(vocab):
-                if len(vocab) == len(vocab_in) and len(vocab_unique) == len(vocab_unique):
+            elif len(set(vocab)) != len(vocab):
+                if len(vocab) == len(vocab_in):
                     return True
             return False
 
+        def get_vocab_pattern(vocab):
+            return re.compile(r'|'.join(sorted(set(vocab), reverse=True)).lower())
+
         if vocab_to_keep:
             assert len(seed_sentences) == len(vocab_to_keep), '{} != {}'.format(len(seed_sentences), len(vocab_to_keep))
         topk_buffer = 100
-        self.__load_model()
         if type(seed_sentences) is str:
             seed_sentences = [seed_sentences]
 
-        data = get_encoding(seed_sentences, self.tokenizer, self.max_length, token_wise_mask=token_wise_mask)
+        data = self.__get_encoding(
+            seed_sentences, token_wise_mask=token_wise_mask, encode_cache=encode_cache if token_wise_mask else None)
         partition = get_partition(data)
-        data_loader = torch.utils.data.DataLoader(
-            Dataset(list(chain(*data))),
-            num_workers=self.num_worker, batch_size=batch_size, shuffle=False, drop_last=False)
+        data = list(chain(*data))
+        # sort by length so that each batch has less padding
+        order = get_length_order(data)
+        data_loader = self.__get_data_loader([data[i] for i in order], batch_size)
 
         logging.debug('\t* prediction on masked tokens')
-        total_input, total_val, total_ind, labels = [], [], [], []
-        with torch.no_grad():
+        # input ids and a list of (position, row in topk arrays) of masked tokens for each encode
+        total_input, total_masked, total_val, total_ind = [], [], [], []
+        n_row = 0
+        with torch.inference_mode():
             for encode in tqdm(data_loader):
-                encode = {k: v.to(self.device) for k, v in encode.items()}
-                output = self.model(**encode, return_dict=True)
-                prediction_scores = output['logits']
-                values, indices = prediction_scores.topk(topk_buffer, dim=-1)
-                total_input += encode.pop('input_ids').tolist()
-                total_val += values.tolist()
-                total_ind += indices.tolist()
-                if 'labels' in encode:
-                    labels += encode.pop('labels').tolist()
+                encode = {k: v.to(self.device, non_blocking=True) for k, v in encode.items()}
+                labels = encode.pop('labels', None)
+                with self.__autocast():
+                    output = self.model(**encode, return_dict=True)
+                if labels is None:
+                    mask_position = encode['input_ids'] == self.tokenizer.mask_token_id
+                else:
+                    mask_position = labels != PAD_TOKEN_LABEL_ID
+                # topk only over the masked positions
+                values, indices = output['logits'][mask_position].topk(topk_buffer, dim=-1)
+                batch_index, position_index = mask_position.nonzero(as_tuple=True)
+                masked = [[] for _ in range(len(mask_position))]
+                for row, (b, p) in enumerate(zip(batch_index.tolist(), position_index.tolist())):
+                    masked[b].append((p, n_row + row))
+                n_row += len(values)
+                total_val.append(values.float().cpu().numpy())
+                total_ind.append(indices.cpu().numpy())
+                # drop batch padding so that decode does not depend on the batch
+                length = encode['attention_mask'].sum(-1).long().tolist()
+                total_input += [inp[:n] for inp, n in zip(encode['input_ids'].tolist(), length)]
+                total_masked += masked
+        # restore the original order
+        total_input = restore_order(total_input, order)
+        total_masked = restore_order(total_masked, order)
+        if len(total_val):
+            total_val, total_ind = np.concatenate(total_val), np.concatenate(total_ind)
 
         greedy_filling = []
+        decode_cache = {}  # cleaned decode of token ids, shared across partitions
         logging.debug('\t* filter to top {} prediction'.format(topk))
         for partition_n, (s, e) in enumerate(tqdm(partition)):
             v = None
+            v_pattern, v_pattern_word, v_pattern_unique = [], [], None
             v_mask = False
             if vocab_to_keep:
                 # convert all tokens from keep_vocab to suitable form of the tokenizer
@@ -453,49 +589,45 @@ class Prompter:
                 if len(sent) == 0:
                     greedy_filling.append([seed_sentences[partition_n]])
                     continue
+                v_pattern = [re.compile(x) for x in v]
+                v_pattern_word = [re.compile(r'\b{}\b'.format(x)) for x in v]
+                v_pattern_unique = get_vocab_pattern(v)
 
             def process_single_pair(_topk, allow_subword=False):
                 topk_decoded = []
+                # candidate token ids and their likelihood
+                all_tokens, all_likelihood = [], []
                 for i in range(s, e):
-                    inp, val, ind = total_input[i], total_val[i], total_ind[i]
-                    if labels:
-                        label = labels[i]
-                        filtered = list(filter(
-                            lambda x: label[x[0]] != PAD_TOKEN_LABEL_ID, enumerate(zip(val, ind))))
-                    else:
-                        filtered = list(filter(
-                            lambda x: inp[x[0]] == self.tokenizer.mask_token_id, enumerate(zip(val, ind))))
-
-                    def decode_topk(k, replace_pos, token_index, token_likelihood):
-                        tokens = deepcopy(inp)
-                        tokens[replace_pos] = token_index[k]
-                        decoded = self.tokenizer.decode(tokens, skip_special_tokens=False)
-                        decoded = self.cleanup_decode(decoded)
-                        decoded_no_mask = decoded.replace(self.tokenizer.mask_token, '')
-                        if v:
-                            if allow_subword:
-                                # very important to apply re.escape, otherwise it gets error if x contains special
-                                # characters such as ()[]\.
-                                if not all(map(lambda x: len(re.findall(r'{}'.format(x), decoded_no_mask.lower())), v)):
-                                    return None
-                            else:
-                                if not all(map(lambda x: len(re.findall(
-                                        r'\b{}\b'.format(x), decoded_no_mask.lower())), v)):
-                                    return None
-
-                            # check if all tokens from keep_vocab just appeared once
-
-                            if not check_vocab(decoded_no_mask, v):
-                                return None
-                        if v_mask and self.tokenizer.mask_token not in decoded:
-                            return None
-
-                        return decoded, token_likelihood[k]
-
-                    for _replace_pos, (_val, _ind) in filtered:
-                        topk_decoded += list(filter(
-                            None, map(lambda x: decode_topk(x, _replace_pos, _ind, _val), range(_topk))
-                        ))
+                    inp = total_input[i]
+                    for _replace_pos, row in total_masked[i]:
+                        _val, _ind = total_val[row, :_topk].tolist(), total_ind[row, :_topk].tolist()
+                        for k in range(_topk):
+                            tokens = inp[:]
+                            tokens[_replace_pos] = _ind[k]
+                            all_tokens.append(tuple(tokens))
+                            all_likelihood.append(_val[k])
+
+                # decode the candidates that have not been decoded yet in a single batch
+                new_tokens = list({t: None for t in all_tokens if t not in decode_cache}.keys())
+                if len(new_tokens):
+                    decoded_all = self.tokenizer.batch_decode([list(t) for t in new_tokens], skip_special_tokens=False)
+                    decode_cache.update({t: self.cleanup_decode(d) for t, d in zip(new_tokens, decoded_all)})
+
+                patterns = v_pattern if allow_subword else v_pattern_word
+                for tokens, likelihood in zip(all_tokens, all_likelihood):
+                    decoded = decode_cache[tokens]
+                    decoded_no_mask = decoded.replace(self.tokenizer.mask_token, '')
+                    if v:
+                        # patterns are built from re.escape-d vocab, otherwise it gets error if x contains special
+                        # characters such as ()[]\.
+                        if not all(p.search(decoded_no_mask.lower()) for p in patterns):
+                            continue
+                        # check if all tokens from keep_vocab just appeared once
+                        if not check_vocab(decoded_no_mask, v, v_pattern_unique):
+                            continue
+                    if v_mask and self.tokenizer.mask_token not in decoded:
+                        continue
+                    topk_decoded.append((decoded, likelihood))
                 return topk_decoded
 
             topk_edit = process_single_pair(topk)
@@ -512,16 +644,20 @@ class Prompter:
                 raise ValueError('no valid sentence found: ({})\n- current prompt: {}'.format(
                     vocab_to_keep[partition_n], seed_sentences[partition_n]))
             # drop duplicated decode and keep the one with the highest likelihood
-            topk_edit = list(map(
-                lambda d: max(filter(lambda x: x[0] == d, topk_edit), key=lambda x: x[1]),
-                set(list(zip(*topk_edit))[0])
-            ))
-            topk_edit = sorted(topk_edit, key=lambda x: x[1], reverse=True)
-            topk_candidate = list(zip(*topk_edit))[0][:min(topk, len(topk_edit))]
+            best_likelihood = {}
+            for decoded, likelihood in topk_edit:
+                if decoded not in best_likelihood or likelihood > best_likelihood[decoded]:
+                    best_likelihood[decoded] = likelihood
+            topk_edit = heapq.nlargest(topk, best_likelihood.items(), key=lambda x: x[1])
+            topk_candidate = [decoded for decoded, _ in topk_edit]
             greedy_filling.append(topk_candidate)
         logging.debug('\t* ppl re-ranking')
         partition = get_partition(greedy_filling)
-        list_ppl = self.get_perplexity(list(chain(*greedy_filling)), batch_size=batch_size)
+        # compute perplexity once for each unique candidate
+        flat_filling = list(chain(*greedy_filling))
+        unique_filling = {k: n for n, k in enumerate(dict.fromkeys(flat_filling))}
+        unique_ppl = self.get_perplexity(list(unique_filling.keys()), batch_size=batch_size, encode_cache=encode_cache)
+        list_ppl = [unique_ppl[unique_filling[f]] for f in flat_filling]
         list_ppl = [list_ppl[s:e] for s, e in partition]
         best_edit = []
         best_ppl = []
@@ -537,59 +673,77 @@ class Prompter:
                 break
         return best_edit, best_ppl
 
-    def get_perplexity(self, sentences, batch_size: int = 4):
+    def get_perplexity(self, sentences, batch_size: int = 4, encode_cache: Dict = None):
         """ Compute perplexity on sentences
 
         Parameters
         ----------
         batch_size :
         sentences : a list of strings
+        encode_cache : (optional) a dictionary of sentence to token-wise masked encodes to reuse and update
 
         Returns
         ----------
         A list of perplexity
         """
-        self.__load_model()
         if type(sentences) is str:
             sentences = [sentences]
-        data = get_encoding(sentences, self.tokenizer, self.max_length, token_wise_mask=True)
+        # only compute perplexity on sentences that are not cached yet
+        new_sentences = list(dict.fromkeys(s for s in sentences if s not in self.ppl_cache))
+        if len(new_sentences):
+            self.ppl_cache.update(zip(new_sentences, self.__get_perplexity(new_sentences, batch_size, encode_cache)))
+        return [self.ppl_cache[s] for s in sentences]
+
+    def __get_perplexity(self, sentences: List, batch_size: int, encode_cache: Dict = None):
+        """ Compute perplexity on sentences without cache """
+        data = self.__get_encoding(sentences, token_wise_mask=True, encode_cache=encode_cache)
         partition = get_partition(data)
-        data_loader = torch.utils.data.DataLoader(
-            Dataset(list(chain(*data))),
-            num_workers=self.num_worker, batch_size=batch_size, shuffle=False, drop_last=False)
+        data = list(chain(*data))
+        # sort by length so that each batch has less padding
+        order = get_length_order(data)
+        data_loader = self.__get_data_loader([data[i] for i in order], batch_size)
         loss_fct = nn.CrossEntropyLoss(reduction='none')
         nll = []
-        with torch.no_grad():
+        with torch.inference_mode():
             for encode in tqdm(data_loader):
-                encode = {k: v.to(self.device) for k, v in encode.items()}
+                encode = {k: v.to(self.device, non_blocking=True) for k, v in encode.items()}
                 labels = encode.pop('labels')
-                output = self.model(**encode, return_dict=True)
-                prediction_scores = output['logits']
+                with self.__autocast():
+                    output = self.model(**encode, return_dict=True)
+                # back to fp32 to keep the loss exact
+                prediction_scores = output['logits'].float()
                 loss = loss_fct(prediction_scores.view(-1, self.config.vocab_size), labels.view(-1))
                 loss = loss.view(len(prediction_scores), -1)
-                loss = torch.sum(loss, -1)
-                nll += list(map(
-                    lambda x: x[0] / sum(map(lambda y: y != PAD_TOKEN_LABEL_ID, x[1])),
-                    zip(loss.cpu().tolist(), labels.cpu().tolist())
-                ))
-        return list(map(lambda x: math.exp(sum(nll[x[0]:x[1]]) / (x[1] - x[0])), partition))
+                # average over non-padding labels on device and only transfer the per-example nll
+                token_count = (labels != PAD_TOKEN_LABEL_ID).sum(-1).clamp_min(1)
+                nll.append((loss.sum(-1) / token_count).cpu())
+        # restore the original order
+        nll = torch.cat(nll).double()
+        nll[torch.tensor(order, dtype=torch.long)] = nll.clone()
+        # mean nll over the encodes of each sentence via cumulative sum
+        nll_cumsum = torch.cat([torch.zeros(1, dtype=torch.float64), nll.cumsum(0)])
+        start, end = torch.tensor(partition, dtype=torch.long).view(-1, 2).t()
+        return torch.exp((nll_cumsum[end] - nll_cumsum[start]) / (end - start)).tolist()
 
     def get_embedding(self, sentences, batch_size: int = 4, return_cls: bool = False):
-        """ Get averaged embedding over context """
-        self.__load_model()
+        """ Get averaged embedding over context (one embedding for each sentence) """
         if type(sentences) is str:
             sentences = [sentences]
-        data = get_encoding(sentences, self.tokenizer, self.max_length, token_wise_mask=True)
-        data_loader = torch.utils.data.DataLoader(
-            Dataset(list(chain(*data))),
-            num_workers=self.num_worker, batch_size=batch_size, shuffle=False, drop_last=False)
+        if len(sentences) == 0:
+            return []
+        # encode each sentence once as it is, not the token-wise masked variants used for perplexity
+        encode = self.tokenizer(sentences, max_length=self.max_length, truncation=True)
+        data = [{k: v[i] for k, v in encode.items()} for i in range(len(sentences))]
+        # sort by length so that each batch has less padding
+        order = get_length_order(data)
+        data_loader = self.__get_data_loader([data[i] for i in order], batch_size)
         embeddings = []
-        with torch.no_grad():
+        with torch.inference_mode():
             for encode in tqdm(data_loader):
-                encode = {k: v.to(self.device) for k, v in encode.items()}
-                encode.pop('labels')
-                out = self.model(**encode, return_dict=True)
-                embedding = out['hidden_states'][-1]
+                encode = {k: v.to(self.device, non_blocking=True) for k, v in encode.items()}
+                with self.__autocast():
+                    out = self.model(**encode, return_dict=True)
+                embedding = out['hidden_states'][-1].float()
                 if return_cls:
                     embeddings += embedding[:, 0, :].cpu().tolist()
                 else:
@@ -599,8 +753,20 @@ class Prompter:
                     length = mask_.sum(-1).view(-1, 1)
                     y = (embedding * mask).sum(1) / length
                     embeddings += y.cpu().tolist()
-        return embeddings
+        return restore_order(embeddings, order)
 
     def release_cache(self):
+        self.ppl_cache = {}
         if self.device == "cuda":
             torch.cuda.empty_cache()
+
+    def close(self):
+        """ Close the on-disk encode cache """
+        if self.encode_cache is not None:
+            self.encode_cache.close()
+            self.encode_cache = None
+
+    def __del__(self):
+        # `__init__` may fail before `encode_cache` is set
+        if getattr(self, 'encode_cache', None) is not None:
+            self.close()
@@ -4,10 +4,17 @@ import json
 import pickle
 import os
 import re
+import time
 from itertools import chain
 from glob import glob
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
 import bertprompt
 
+SENTINEL_HEAD = '\x00H\x00'
+SENTINEL_TAIL = '\x00T\x00'
+
 
 def get_options():
     parser = argparse.ArgumentParser(description='Run analogy test with prompt.')
@@ -23,76 +30,181 @@ def get_options():
     parser.add_argument('--mode', help='Inference mode (ppl/avg)', default='avg', type=str)
     parser.add_argument('--prompt-mode', help='Prompt mode (stem/all)', default='stem', type=str)
     parser.add_argument('--debug', help='Show debug log', action='store_true')
+    parser.add_argument('--compile', help='Compile the language model (PyTorch 2.x)', action='store_true')
+    parser.add_argument('--dtype', help='Inference precision on GPU (fp16/bf16/fp32)', default='fp16', type=str)
+    parser.add_argument('--prompt-dtype', help='Precision the prompts were generated with (fp16/bf16/fp32)',
+                        default='fp16', type=str)
+    parser.add_argument('--runtime', help='Inference runtime (torch/ort)', default='torch', type=str)
+    parser.add_argument('--autotune-batch', help='Pick the fastest batch size before inference', action='store_true')
     return parser.parse_args()
 
 
-def get_best_prompt(file_list):
-    """ Get best prompt in terms of ppl. """
+class ORTEncoder:
+    """ ONNX Runtime (fp16 optimized graph) encoder that can replace `Prompter.model` for `Prompter.get_embedding`. """
+
+    def __init__(self, model_name: str, export_dir: str):
+        from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTOptimizer
+        from optimum.onnxruntime.configuration import OptimizationConfig
+        file_name = 'model_optimized.onnx'
+        if not os.path.exists('{}/{}'.format(export_dir, file_name)):
+            model = ORTModelForFeatureExtraction.from_pretrained(
+                model_name, export=True, provider='CUDAExecutionProvider')
+            config = OptimizationConfig(optimization_level=99, optimize_for_gpu=True, fp16=True)
+            ORTOptimizer.from_pretrained(model).optimize(save_dir=export_dir, optimization_config=config)
+        self.model = ORTModelForFeatureExtraction.from_pretrained(
+            export_dir, file_name=file_name, provider='CUDAExecutionProvider', use_io_binding=True)
+
+    def __call__(self, return_dict: bool = True, **kwargs):
+        # the exported graph takes int64 inputs while `Dataset` gives a float attention mask
+        kwargs = {k: v.long() for k, v in kwargs.items()}
+        # `get_embedding` only uses the last hidden state
+        return {'hidden_states': [self.model(**kwargs).last_hidden_state]}
+
+
+def load_ort(prompter, export_dir, sample, tolerance: float = 5e-2):
+    """ Swap the model of `prompter` with `ORTEncoder` and check the embedding on sample against the torch model
+    (max abs diff within `tolerance`). """
+    embedding_torch = prompter.get_embedding(sample)
+    prompter.model = ORTEncoder(prompter.model_name, export_dir)
+    embedding_ort = prompter.get_embedding(sample)
+    diff = max(abs(a - b) for x, y in zip(embedding_torch, embedding_ort) for a, b in zip(x, y))
+    logging.info('ONNX Runtime model loaded (max abs diff of embedding on sample: {})'.format(diff))
+    if not diff <= tolerance:
+        raise ValueError('ONNX Runtime embedding differs from the torch model: {} > {}'.format(diff, tolerance))
+    return prompter
 
-    def safe_load(_file):
-        with open(_file, 'r') as f:
-            return json.load(f)
 
-    list_prompt = list(map(safe_load, file_list))
+def autotune_batch_size(prompter, sentences, cache_file, return_cls: bool = False, runtime: str = 'torch',
+                        sample_size: int = 256, candidates=(32, 64, 128, 256, 512, 1024)):
+    """ Get the batch size with the highest throughput on a sample of the longest (95th percentile) prompts. The
+    result is cached in a json file for each (model, length, dtype, runtime, return_cls, length bucket). """
+    if len(sentences) == 0:
+        return candidates[0]
+    lengths = [len(i) for i in prompter.tokenizer(sentences)['input_ids']]
+    order = sorted(range(len(sentences)), key=lambda x: lengths[x])
+    end = min(len(order), max(sample_size, int(len(order) * 0.95)))
+    sample = [sentences[i] for i in order[max(0, end - sample_size):end]]
+    key = '{}.{}.{}.{}.{}.{}'.format(prompter.model_name, prompter.max_length, prompter.dtype, runtime,
+                                     int(return_cls), lengths[order[end - 1]] // 8)
+    cache = {}
+    if os.path.exists(cache_file):
+        with open(cache_file, 'r') as f:
+            cache = json.load(f)
+    if key in cache:
+        return cache[key]
+
+    def get_throughput(batch_size):
+        """ Prompts per second with `batch_size` after an untimed warm-up run at the same shape (kernel autotuning,
+        compilation), or None if it runs out of memory. """
+        try:
+            prompter.get_embedding(sample, batch_size=batch_size, return_cls=return_cls)
+            start = time.time()
+            prompter.get_embedding(sample, batch_size=batch_size, return_cls=return_cls)
+            throughput = len(sample) / (time.time() - start)
+        except RuntimeError as e:
+            if 'out of memory' not in str(e):
+                raise
+            logging.info('\t batch size {}: out of memory'.format(batch_size))
+            prompter.release_cache()
+            return None
+        logging.info('\t batch size {}: {:.1f} prompts/sec'.format(batch_size, throughput))
+        return throughput
+
+    # halve the batch size until it fits in memory
+    best_batch = candidates[0]
+    best_throughput = get_throughput(best_batch)
+    while best_throughput is None:
+        assert best_batch > 1, 'out of memory with batch size 1'
+        best_batch //= 2
+        best_throughput = get_throughput(best_batch)
+    # larger candidates can only fit if the smallest one did
+    for batch_size in candidates[1:] if best_batch == candidates[0] else []:
+        throughput = get_throughput(batch_size)
+        if throughput is None:
+            break
+        if throughput > best_throughput:
+            best_batch, best_throughput = batch_size, throughput
+    cache[key] = best_batch
+    with open(cache_file, 'w') as f:
+        json.dump(cache, f)
+    return best_batch
+
+
+def get_best_prompt(file_list):
+    """ Get best prompt in terms of ppl. """
+    # load files in parallel threads as it is I/O bound
+    with ThreadPoolExecutor(max_workers=min(16, len(file_list))) as executor:
+        list_prompt = list(executor.map(bertprompt.data.load_json, file_list))
     optimal_prompt = {}
     for k in list_prompt[0].keys():
         prompts = list(chain(*[p[k][0] for p in list_prompt]))
-        scores = list(chain(*[p[k][1] for p in list_prompt]))
+        scores = np.fromiter(chain.from_iterable(p[k][1] for p in list_prompt), dtype=np.float64)
         assert len(prompts) == len(scores), '{} != {}'.format(len(prompts), len(scores))
-        best_index = scores.index(min(scores))
-        optimal_prompt[k] = [[prompts[best_index]], [scores[best_index]]]
+        best_index = int(scores.argmin())
+        optimal_prompt[k] = [[prompts[best_index]], [float(scores[best_index])]]
     return optimal_prompt
 
 
 def main():
     opt = get_options()
+    # inference only: autotune kernels for the repeated shapes and skip autograd bookkeeping
+    torch.backends.cudnn.benchmark = True
+    torch.set_grad_enabled(False)
     level = logging.DEBUG if opt.debug else logging.INFO
     logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', level=level, datefmt='%Y-%m-%d %H:%M:%S')
     logging.info('RUN ANALOGY TEST WITH PROMPT')
-    path = '{0}/{1}/prompt_dict.{1}.{2}.{3}*json'.format(
-        opt.prompt_dir, opt.data, opt.transformers_model, opt.topk)
+    path = '{0}/{1}/prompt_dict.{1}.{2}.{3}.{4}.*json'.format(
+        opt.prompt_dir, opt.data, opt.transformers_model, opt.topk, opt.prompt_dtype)
     list_prompt = sorted(glob(path))
     assert len(list_prompt), path
-    file_best_prompt = '{0}/{1}/prompt_dict.{1}.{2}.{3}.best.json'.format(
-        opt.prompt_dir, opt.data, opt.transformers_model, opt.topk)
+    file_best_prompt = '{0}/{1}/prompt_dict.{1}.{2}.{3}.{4}.best.json'.format(
+        opt.prompt_dir, opt.data, opt.transformers_model, opt.topk, opt.prompt_dtype)
     if file_best_prompt not in list_prompt:
         best_prompt = get_best_prompt(list_prompt)
-        with open(file_best_prompt, 'w') as f:
-            json.dump(best_prompt, f)
+        bertprompt.data.dump_json(best_prompt, file_best_prompt)
         list_prompt += [file_best_prompt]
 
     # list_prompt = [file_best_prompt]
 
     accuracy_full = {}
     os.makedirs(opt.output_dir, exist_ok=True)
+    # prompter shared across prompt files, loaded at the first cache miss
+    prompter = None
+    # dataset and its stem keys do not depend on the prompt file
+    val, test = bertprompt.get_analogy_data(opt.data)
+    full_data = val + test
+    stem_keys = ['||'.join(data_['stem']) for data_ in full_data]
 
     for _file in list_prompt:
         logging.info('Running inference on {}'.format(_file))
         filename = os.path.basename(_file).replace('.json', '')
 
-        with open(_file, 'r') as f_dict:
-            prompt_dict = json.load(f_dict)
+        prompt_dict = bertprompt.data.load_json(_file)
 
-        cache_file = '{0}/cache/{1}.{2}.{3}.pkl'.format(opt.output_dir, filename, opt.mode, opt.prompt_mode)
+        cache_file = '{0}/cache/{1}.{2}.{3}.{4}.{5}.pkl'.format(
+            opt.output_dir, filename, opt.mode, opt.prompt_mode, opt.dtype, opt.runtime)
         os.makedirs(os.path.dirname(cache_file), exist_ok=True)
-        val, test = bertprompt.get_analogy_data(opt.data)
         if opt.prompt_mode == 'stem':
+            templates = [prompt_dict[k][0][-1] for k in stem_keys]  # get last prompt
             all_pairs = []
             all_template = []
-            for data_ in val + test:
+            for data_, template in zip(full_data, templates):
                 h, t = data_['stem']
-                template = prompt_dict['||'.join([h, t])][0][-1]
                 all_pairs.append([h, t])
                 all_template.append(template)
-                h_var = re.findall(h, template, re.IGNORECASE)
-                t_var = re.findall(t, template, re.IGNORECASE)
-                assert len(h_var) and len(t_var), '`{}` and `{}` not in `{}`'.format(h, t, template)
-
-                for h_c, t_c in data_['choice']:
-                    all_pairs.append([h_c, t_c])
-                    all_template.append(re.sub(r'|'.join(t_var), t_c, re.sub(r'|'.join(h_var), h_c, template)))
+                h_var = re.findall(re.escape(h), template, re.IGNORECASE)
+                t_var = re.findall(re.escape(t), template, re.IGNORECASE)
+                if not len(h_var) or not len(t_var):
+                    # an empty pattern would put the sentinel between every character
+                    raise ValueError('`{}` and `{}` not in `{}` ({})'.format(h, t, template, _file))
+                # replace the stem with sentinels once, so that a choice word is never substituted again
+                template_sentinel = re.sub(r'|'.join(map(re.escape, h_var)), SENTINEL_HEAD, template)
+                template_sentinel = re.sub(r'|'.join(map(re.escape, t_var)), SENTINEL_TAIL, template_sentinel)
+                all_pairs += data_['choice']
+                all_template += [template_sentinel.replace(SENTINEL_HEAD, h_c).replace(SENTINEL_TAIL, t_c)
+                                 for h_c, t_c in data_['choice']]
         elif opt.prompt_mode == 'all':
-            all_pairs = list(chain(*[[o['stem']] + o['choice'] for o in val + test]))
+            all_pairs = list(chain(*[[o['stem']] + o['choice'] for o in full_data]))
             all_template = [prompt_dict['||'.join([h, t])][0][-1] for h, t in all_pairs]  # get last prompt
         else:
             raise ValueError('unknown prompt_mode: {}'.format(opt.prompt_mode))
@@ -103,51 +215,67 @@ def main():
                 with open(cache_file, "rb") as fp:
                     embedding = pickle.load(fp)
             else:
-                prompter = bertprompt.Prompter(opt.transformers_model, opt.length)
-                embedding = prompter.get_embedding(all_template, batch_size=opt.batch, return_cls=opt.mode == 'cls')
+                if prompter is None:
+                    prompter = bertprompt.Prompter(
+                        opt.transformers_model, opt.length, compile_model=opt.compile, dtype=opt.dtype)
+                    if opt.runtime == 'ort':
+                        load_ort(prompter, '{}/onnx/{}'.format(opt.output_dir, opt.transformers_model),
+                                 all_template[:8])
+                    elif opt.runtime != 'torch':
+                        raise ValueError('unknown runtime: {}'.format(opt.runtime))
+                # compute embedding once for each unique prompt
+                unique_template = list(dict.fromkeys(all_template))
+                batch_size = opt.batch
+                if opt.autotune_batch:
+                    batch_size = autotune_batch_size(
+                        prompter, unique_template, '{}/batch_size.json'.format(opt.output_dir),
+                        return_cls=opt.mode == 'cls', runtime=opt.runtime)
+                    logging.info('tuned batch size: {}'.format(batch_size))
+                with torch.inference_mode():
+                    unique_embedding = prompter.get_embedding(
+                        unique_template, batch_size=batch_size, return_cls=opt.mode == 'cls')
+                assert len(unique_embedding) == len(unique_template), '{} != {}'.format(
+                    len(unique_embedding), len(unique_template))
+                unique_embedding = dict(zip(unique_template, unique_embedding))
+                embedding = [unique_embedding[t] for t in all_template]
                 with open(cache_file, 'wb') as fp:
                     pickle.dump(embedding, fp)
 
             embedding_dict = {str(k): v for k, v in zip(all_pairs, embedding)}
 
-            def cos_similarity(a_, b_):
-                # return - sum(list(map(lambda x: (x[0] - x[1]) ** 2, zip(a_, b_)))) ** 0.5
-                inner = sum(list(map(lambda x: x[0] * x[1], zip(a_, b_))))
-                norm_a = sum(list(map(lambda x: x * x, a_))) ** 0.5
-                norm_b = sum(list(map(lambda x: x * x, b_))) ** 0.5
-                return inner / (norm_b * norm_a)
-
-            prediction = []
-            for single_data in val + test:
-                v_choice = [embedding_dict[str(c)] for c in single_data['choice']]
-                v_stem = embedding_dict[str(single_data['stem'])]
-                sims = [cos_similarity(v_stem, v) for v in v_choice]
-                pred = sims.index(max(sims))
-                prediction.append(pred)
-                # input()
+            # cosine similarity between stem and choices, padded with -inf for questions with fewer choices
+            sims = np.full((len(full_data), max(len(d['choice']) for d in full_data)), -np.inf)
+            for n, single_data in enumerate(full_data):
+                v_choice = np.array([embedding_dict[str(c)] for c in single_data['choice']])
+                v_stem = np.array(embedding_dict[str(single_data['stem'])])
+                sims[n, :len(v_choice)] = v_choice.dot(v_stem) / (
+                    np.linalg.norm(v_choice, axis=1) * np.linalg.norm(v_stem))
+            prediction = sims.argmax(1)
         # elif opt.mode == 'ppl':
         #     # validity score based on perplexity
         #     # (A, B) and (C, D) --> P_{A, B}(C, D) is used to compute prompt.
         #     prompter = bertprompt.Prompter(opt.transformers_model, opt.length)
         #     score_flat = prompter.get_perplexity(list(chain(*all_template)), batch_size=opt.batch)
-        #     list_choice = [data_['stem'] for data_ in val + test]
+        #     list_choice = [data_['stem'] for data_ in full_data]
         #     partition = bertprompt.get_partition(list_choice)
         #     score = [score_flat[s_:e_] for s_, e_ in partition]
         #     prediction = [s.index(min(s)) for s in score]
         else:
             raise ValueError('unknown mode: {}'.format(opt.mode))
 
-        accuracy = [int(d['answer'] == p) for p, d in zip(prediction, val + test)]
+        accuracy = np.asarray(prediction) == np.array([d['answer'] for d in full_data])
         accuracy_full[filename.replace('prompt_dict.', '')] = {
-            'accuracy_valid': 100 * sum(accuracy[:len(val)]) / len(val),
-            'accuracy_test': 100 * sum(accuracy[len(val):len(val) + len(test)]) / len(test),
-            'accuracy': 100 * sum(accuracy) / len(accuracy)
+            'accuracy_valid': 100 * float(accuracy[:len(val)].mean()),
+            'accuracy_test': 100 * float(accuracy[len(val):len(val) + len(test)].mean()),
+            'accuracy': 100 * float(accuracy.mean())
         }
         logging.info('accuracy: \n{}'.format(
             json.dumps(accuracy_full[filename.replace('prompt_dict.', '')], indent=4, sort_keys=True)
         ))
     logging.info('All result:\n{}'.format(json.dumps(accuracy_full, indent=4, sort_keys=True)))
-    path = '{0}/{1}.{2}.{3}.{4}.json'.format(opt.output_dir, opt.data, opt.transformers_model, opt.topk, opt.mode, opt.prompt_mode)
+    path = '{0}/{1}.{2}.{3}.{4}.{5}.{6}.{7}.{8}.json'.format(
+        opt.output_dir, opt.data, opt.transformers_model, opt.topk, opt.prompt_dtype, opt.mode, opt.prompt_mode,
+        opt.dtype, opt.runtime)
     os.makedirs(opt.output_dir, exist_ok=True)
     with open(path, 'w') as f:
         json.dump(accuracy_full, f)
@@ -1,12 +1,17 @@
 """ Generate prompt for SAT type analogy dataset """
 import argparse
-import json
 import os
 import logging
+import sqlite3
 from glob import glob
 from itertools import chain, product
+from concurrent.futures import ThreadPoolExecutor
+import torch
 import bertprompt
 
+# background writer for the sub-experiment files, so that generation is not blocked by disk
+io_pool = ThreadPoolExecutor(max_workers=2)
+
 
 def get_options():
     parser = argparse.ArgumentParser(description='Generate prompt for SAT type analogy dataset')
@@ -25,11 +30,29 @@ def get_options():
     parser.add_argument('--debug', help='Show debug log', action='store_true')
     parser.add_argument('--unique', help='Drop duplicated word in prompt', action='store_true')
     parser.add_argument('--log-file', help='Export log file', default=None, type=str)
+    parser.add_argument('--no-clean', help='Keep cached sub-experiment files', action='store_true')
+    parser.add_argument('--compile', help='Compile the language model (PyTorch 2.x)', action='store_true')
+    parser.add_argument('--dtype', help='Inference precision on GPU (fp16/bf16/fp32)', default='fp16', type=str)
+    parser.add_argument('--encode-cache-dir', help='Directory to persist tokenizer encodes across runs', default=None,
+                        type=str)
     return parser.parse_args()
 
 
+def open_pair_cache(path):
+    """ SQLite cache of the generated prompt for each word pair and configuration. """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE IF NOT EXISTS prompt (model TEXT, length INT, dtype TEXT, topk INT, revision INT, '
+                 'nb INT, nbb INT, nbe INT, uniq INT, pair TEXT, result TEXT, '
+                 'PRIMARY KEY (model, length, dtype, topk, revision, nb, nbb, nbe, uniq, pair))')
+    return conn
+
+
 def main():
     opt = get_options()
+    # inference only: autotune kernels for the repeated shapes and skip autograd bookkeeping
+    torch.backends.cudnn.benchmark = True
+    torch.set_grad_enabled(False)
     level = logging.DEBUG if opt.debug else logging.INFO
     logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', level=level, datefmt='%Y-%m-%d %H:%M:%S')
     if opt.log_file is not None:
@@ -40,7 +63,8 @@ def main():
         file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)-8s %(message)s'))
         logger.addHandler(file_handler)
 
-    prompter = bertprompt.Prompter(opt.transformers_model, opt.length)
+    prompter = bertprompt.Prompter(opt.transformers_model, opt.length, compile_model=opt.compile, dtype=opt.dtype,
+                                   encode_cache_dir=opt.encode_cache_dir)
 
     # aggregate data
     n_blank_list = [int(i) for i in opt.n_blank.split(',')]
@@ -49,9 +73,9 @@ def main():
     val, test = bertprompt.get_analogy_data(opt.data)
     word_pairs = list(chain(*[[i['stem']] + i['choice'] for i in val]))
     word_pairs += list(chain(*[[i['stem']] + i['choice'] for i in test]))
-    word_pairs += [[p[1], p[0]] for p in word_pairs]
-    # drop duplicated pair
-    word_pairs = [i.split('||') for i in sorted({'||'.join(i) for i in word_pairs})]
+    # drop duplicated pair regardless of the direction, then expand each pair to both directions
+    canonical = {tuple(sorted(p)) for p in word_pairs}
+    word_pairs = [list(p) for p in sorted({q for p in canonical for q in (p, p[::-1])}, key='||'.join)]
     all_config = list(product(n_blank_list, n_blank_b_list, n_blank_e_list))
 
     # language model inference
@@ -62,11 +86,14 @@ def main():
     logging.info('\t * blank (b): {}'.format(n_blank_b_list))
     logging.info('\t * blank (e): {}'.format(n_blank_e_list))
 
+    pair_cache = open_pair_cache('{}/pair_cache.db'.format(opt.output_dir))
+    # sub-experiment files to delete once every config has finished
+    to_delete = []
     for i, (n_blank, n_blank_b, n_blank_e) in enumerate(all_config):
         logging.info('EXPERIMENT {}/{}: blank: {}, blank_b: {}, blank_e: {}'.format(
             i, len(all_config), n_blank, n_blank_b, n_blank_e))
-        filename = '{0}/{1}/prompt_dict.{1}.{2}.{3}.{4}.{5}.{6}.json'.format(
-            opt.output_dir, opt.data, opt.transformers_model, opt.topk, n_blank, n_blank_b, n_blank_e)
+        filename = '{0}/{1}/prompt_dict.{1}.{2}.{3}.{4}.{5}.{6}.{7}.json'.format(
+            opt.output_dir, opt.data, opt.transformers_model, opt.topk, opt.dtype, n_blank, n_blank_b, n_blank_e)
 
         if opt.unique:
             filename = filename.replace('.json', '.unique.json')
@@ -74,8 +101,16 @@ def main():
         os.makedirs(os.path.dirname(filename), exist_ok=True)
         if os.path.exists(filename):
             logging.info('skip as the output found at: {}'.format(filename))
+            # sub-experiment files left by an interrupted run
+            to_delete += glob(filename.replace('.json', '.sub.*.json'))
             continue
+        config = (opt.transformers_model, opt.length, opt.dtype, opt.topk, opt.revision, n_blank, n_blank_b, n_blank_e,
+                  int(opt.unique))
+        cached = dict(pair_cache.execute(
+            'SELECT pair, result FROM prompt WHERE model=? AND length=? AND dtype=? AND topk=? AND revision=? '
+            'AND nb=? AND nbb=? AND nbe=? AND uniq=?', config))
         files = []
+        writes = []
         total_range = range(0, len(word_pairs), opt.max_data_size)
         for n_, n in enumerate(total_range):
             end = min(n + opt.max_data_size, len(word_pairs))
@@ -83,33 +118,47 @@ def main():
             filename_ = filename.replace('.json', '.sub.{}.{}.json'.format(n_, opt.max_data_size))
             if not os.path.exists(filename_):
                 word_pairs_sub = word_pairs[n:end]
-                output_list_tmp = prompter.generate(
-                    word_pairs_sub,
-                    n_blank=n_blank,
-                    n_blank_b=n_blank_b,
-                    n_blank_e=n_blank_e,
-                    batch_size=opt.batch,
-                    vocab_to_keep_unique=opt.unique,
-                    topk=opt.topk,
-                    n_revision=opt.revision,
-                )
-                with open(filename_, 'w') as f:
-                    json.dump({"||".join(k): v for k, v in zip(word_pairs_sub, output_list_tmp)}, f)
+                # only generate prompt for the pairs missing in the cache
+                word_pairs_new = [p for p in word_pairs_sub if "||".join(p) not in cached]
+                if len(word_pairs_new):
+                    with torch.inference_mode():
+                        output_list_tmp = prompter.generate(
+                            word_pairs_new,
+                            n_blank=n_blank,
+                            n_blank_b=n_blank_b,
+                            n_blank_e=n_blank_e,
+                            batch_size=opt.batch,
+                            vocab_to_keep_unique=opt.unique,
+                            topk=opt.topk,
+                            n_revision=opt.revision,
+                        )
+                    # same codec as `json_loads` below, so that the cache always reads back
+                    new = {"||".join(k): bertprompt.data.json_dumps(v).decode()
+                           for k, v in zip(word_pairs_new, output_list_tmp)}
+                    pair_cache.executemany(
+                        'INSERT OR REPLACE INTO prompt VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        [config + (k, v) for k, v in new.items()])
+                    pair_cache.commit()
+                    cached.update(new)
+                writes.append(io_pool.submit(
+                    bertprompt.data.dump_json,
+                    {"||".join(k): bertprompt.data.json_loads(cached["||".join(k)]) for k in word_pairs_sub},
+                    filename_))
             files.append(filename_)
 
+        # wait for the pending sub-experiment files (and raise any write error)
+        for fut in writes:
+            fut.result()
         logging.info('experiment finished, exporting result to {}'.format(filename))
-        # combine output
-        output_dict = {}
-        for _file in files:
-            with open(_file, 'r') as f:
-                output_dict.update(json.load(f))
-        with open(filename, 'w') as f:
-            json.dump(output_dict, f)
+        # combine output by streaming each sub-experiment file into the output
+        bertprompt.data.dump_json_stream((bertprompt.data.load_json(_file) for _file in files), filename)
+        to_delete += files
+    pair_cache.close()
+    prompter.close()
+    if not opt.no_clean:
         logging.info('deleting cached files')
-        filename = '{0}/{1}/prompt_dict.{1}.{2}.{3}.{4}.{5}.{6}.sub.*.json'.format(
-            opt.output_dir, opt.data, opt.transformers_model, opt.topk, n_blank, n_blank_b, n_blank_e)
-        for p in glob(filename):
-            os.remove(p)
+        for p in to_delete:
+            os.unlink(p)
 
 
 if __name__ == '__main__':
@@ -63,6 +63,7 @@ def main():
     os.makedirs(os.path.dirname(filename), exist_ok=True)
     if os.path.exists(filename):
         logging.info('skip as the output found at: {}'.format(filename))
+        return
     files = []
     total_range = range(0, len(seed_prompt), opt.max_data_size)
     for n_, n in enumerate(total_range):
@@ -32,6 +32,7 @@ setup(
         "transformers",
         "torch",
         "tqdm",
+        "numpy",
         "pandas",
         "requests"
     ],
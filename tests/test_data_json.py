@@ -0,0 +1,36 @@
+""" UnitTest """
+import unittest
+import os
+import json
+import tempfile
+from bertprompt.data import dump_json_stream
+
+
+class Test(unittest.TestCase):
+    """ Test """
+
+    def test_dump_json_stream(self):
+        dicts = [
+            {'dog||cat': [['a dog and a cat', 10.5]], 'café||tea': [['café "and" tea\n', 3.0]]},
+            {},
+            {'sun||moon': [['the sun, the moon', 1.25]], 'dog||cat': [['a cat and a dog', 2.0]]},
+        ]
+        # a repeated key keeps its first value
+        merged = {}
+        for d in dicts[::-1]:
+            merged.update(d)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'merged.json')
+            dump_json_stream(iter(dicts), path)
+            with open(path) as f:
+                pairs = json.load(f, object_pairs_hook=list)
+            self.assertEqual(len(pairs), len(merged))
+            self.assertEqual(dict(pairs), merged)
+
+            dump_json_stream([], path)
+            with open(path) as f:
+                self.assertEqual(json.load(f), {})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,33 @@
+""" UnitTest """
+import unittest
+from bertprompt.lm import get_length_order, restore_order, get_partition
+
+
+class Test(unittest.TestCase):
+    """ Test """
+
+    def test_restore_order(self):
+        data = [{'input_ids': [0] * n} for n in [5, 2, 7, 2, 1, 9, 3]]
+        order = get_length_order(data)
+        data_sorted = [data[i] for i in order]
+        self.assertEqual([len(d['input_ids']) for d in data_sorted], [1, 2, 2, 3, 5, 7, 9])
+        self.assertEqual(restore_order(data_sorted, order), data)
+        # values computed on the sorted list go back to the original position
+        self.assertEqual(restore_order([len(d['input_ids']) for d in data_sorted], order), [5, 2, 7, 2, 1, 9, 3])
+
+    def test_restore_order_empty(self):
+        self.assertEqual(get_length_order([]), [])
+        self.assertEqual(restore_order([], []), [])
+
+    def test_get_partition(self):
+        self.assertEqual(get_partition([]), [])
+        nested = [[1, 2], [], [3], [4, 5, 6]]
+        partition = get_partition(nested)
+        self.assertEqual(partition, [(0, 2), (2, 2), (2, 3), (3, 6)])
+        flat = [i for n in nested for i in n]
+        self.assertEqual([flat[s:e] for s, e in partition], nested)
+        self.assertTrue(all(type(i) is int for p in partition for i in p))
+
+
+if __name__ == "__main__":
+    unittest.main()